@@ -3,12 +3,24 @@
 import requests
 import psycopg2
 import tqdm
-import multiprocessing
+import orjson
+from psycopg2 import sql
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.pool import ThreadedConnectionPool
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import sys
 import os
-import subprocess
 import math
 import argparse
+import functools
+import pwd
+import time
+import queue
+import threading
+import csv
+import io
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 
 __author__ = 'Lev Kokotov <lev.kokotov@instacart.com>'
@@ -20,76 +32,116 @@ DEFAULT_PG_DUMP_BACKUP_DIR = os.path.join(os.environ.get('HOME'), 'Desktop')
 DEFAULT_POSTGRES_DB = 'rollbars'
 DEFAULT_POSTGRES_HOST = '127.0.0.1'
 DEBUG = os.environ.get('DEBUG', 'False') == 'True'
-
-def __execute(cmd):
-    '''Execute a command on the system.
-
-    Arguments:
-        - cmd: str, command to execute in the shell
-    '''
-    if DEBUG:
-        print(f'Executing: {cmd}')
-
-    return subprocess.check_output(cmd)
-
-
+DEFAULT_WORKERS = 32
+DEFAULT_WRITERS = 2
+QUEUE_SIZE = 64 # Pages waiting to be written before fetchers block
+BATCH_SIZE = 1000 # Rows per transaction
+PAGE_SIZE = 20 # Rollbar returns pages of 20 instances and doesn't let us ask for more
+HTTP_TIMEOUT = (3.05, 30) # (connect, read) seconds
+ROLLBAR_API = 'https://api.rollbar.com/api/1'
+COPY_NULL = r'\N' # How insert() spells NULL, so it doesn't collide with ''
+
+# Keep-alive connections to api.rollbar.com, shared by all fetcher threads, created in main().
+SESSION = None
+
+# Postgres connections for the writer threads, created in main().
+POOL = None
+
+@functools.lru_cache(maxsize=1)
 def __unix_user():
     '''Get the current unix user.'''
-    return __execute('whoami').decode('utf-8').strip()
+    return pwd.getpwuid(os.geteuid()).pw_name
 
 
+@functools.lru_cache(maxsize=1)
 def __dbname():
     '''Get desired database name.'''
     return os.environ.get('POSTGRES_DB', DEFAULT_POSTGRES_DB)
 
 
-def setup_rollbar_id(counter: int):
+def setup_rollbar_id(counter: int, rollbar_token: str) -> int:
     '''Get the global Rollbar ID for a counter.
     
     Arguments:
         - counter: int
+        - rollbar_token: str, the Rollbar project access token
     '''
-    rollbar_token = os.environ.get('ROLLBAR_TOKEN')
-    resp = requests.get(f'https://api.rollbar.com/api/1/item_by_counter/{counter}?access_token={rollbar_token}')
+    resp = SESSION.get(f'{ROLLBAR_API}/item_by_counter/{counter}', params={'access_token': rollbar_token}, timeout=HTTP_TIMEOUT)
 
     try:
-        id_ = resp.json()['result']['id']
-        os.environ['ROLLBAR_ID'] = str(id_) # Accessible from all subprocesses
+        return orjson.loads(resp.content)['result']['id']
     except:
         print(f'Could not find Rollbar ID with counter {counter} and given project access token.')
         print('Perhaps the acess token is for the wrong project? Counters are per project, not global.')
         exit(1)
 
 
+def create_db():
+    '''Create the database (if not exists).'''
+    dbname = __dbname()
+
+    # CREATE DATABASE can't run inside a transaction, or from the database being created
+    try:
+        cursor, conn = psql('postgres')
+    except psycopg2.OperationalError:
+        print(f'Could not connect to the "postgres" database to create "{dbname}", assuming it already exists.')
+        return
+
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+
+    try:
+        # Check first: roles without CREATEDB get a privilege error even if the DB exists
+        cursor.execute('SELECT 1 FROM pg_database WHERE datname = %s;', (dbname,))
+
+        if cursor.fetchone():
+            print(f'Database "{dbname}" already exists.')
+        else:
+            print(f'Creating database "{dbname}"...')
+            cursor.execute(sql.SQL('CREATE DATABASE {};').format(sql.Identifier(dbname)))
+    finally:
+        conn.close()
+
+
+def instances_url(rollbar_id: int) -> str:
+    '''Get the URL listing the occurences of a Rollbar.
+
+    Arguments:
+        - rollbar_id: int, the global Rollbar ID (see setup_rollbar_id)
+    '''
+    return f'{ROLLBAR_API}/item/{rollbar_id}/instances'
+
+
 def setup_db(backup=False):
     '''Setup the database from scratch.
     
     Arguments:
         - backup: boolean, backup or not to backup existing DB
     '''
+    create_db()
+
     cursor, conn = psql()
     dbname = __dbname()
 
-    # Doesn't work yet :/
+    # Save the previous import as CSV before it's dropped
     if backup:
-        backup_dir = os.environ.get('PG_DUMP_BACKUP_DIR', DEFAULT_PG_DUMP_BACKUP_DIR)
-        __execute(f'pg_dump {dbname} -f {backup_dir}/{dbname}.sql')
+        cursor.execute("SELECT to_regclass('rollbars');")
 
-    # Create database (if not exists)
-    try:
-        print(f'Creating dabase "{__dbname()}"...')
-        __execute('createdb rollbars')
-    except:
-        print(f'Database "{__dbname()}" already exists.')
+        if cursor.fetchone()[0]:
+            backup_dir = os.environ.get('PG_DUMP_BACKUP_DIR', DEFAULT_PG_DUMP_BACKUP_DIR)
+            backup_file = os.path.join(backup_dir, f'{dbname}.csv')
 
+            print(f'Backing up rollbars to {backup_file}...')
+            with open(backup_file, 'w') as f:
+                cursor.copy_expert('COPY rollbars TO STDOUT WITH (FORMAT CSV, HEADER);', f)
 
     cursor.execute('''
         DROP TABLE IF EXISTS rollbars;
     ''')
 
+    # No WAL during the import; a crash just means running the script again.
     cursor.execute('''
-        CREATE TABLE rollbars (
-            id BIGINT NOT NULL UNIQUE, -- Rollbar instance ID is unique
+        CREATE UNLOGGED TABLE rollbars (
+            id BIGINT NOT NULL, -- Rollbar instance ID is unique, indexed after the import
             project_id BIGINT,
             environment VARCHAR,
             request_path VARCHAR,
@@ -99,73 +151,161 @@ def setup_db(backup=False):
         );
     ''')
 
+    # Rollbars are COPY'd here first, then deduplicated into rollbars by merge().
+    cursor.execute('''
+        DROP TABLE IF EXISTS rollbars_stage;
+    ''')
+
+    cursor.execute('''
+        CREATE UNLOGGED TABLE rollbars_stage (LIKE rollbars); -- No UNIQUE, duplicates are fine here
+    ''')
+
     conn.commit()
     conn.close()
 
 
-def insert(rollbar, cursor):
-    '''Insert a Rollbar into the DB.
+def parse(rollbar):
+    '''Parse a Rollbar into a row for the rollbars table.
     
     Arguments:
         - rollbar: dict, rollbar info
+    '''
+    data = rollbar['data']
+    extra = data['body'].get('message', {}).get('extra', {})
+
+    return (
+        rollbar['id'],
+        rollbar['project_id'],
+        data['environment'],
+        extra.get('request_path', ''),
+        extra.get('status_code', ''),
+        rollbar['timestamp'],
+        data['level'],
+    )
+
+
+def insert(rows, cursor):
+    '''Insert parsed Rollbars into the staging table with COPY.
+    
+    Arguments:
+        - rows: list of tuples, as returned by parse()
         - cursor: psycopg2 cursor
     '''
-    id_ = rollbar['id']
-    project_id = rollbar['project_id']
-    timestamp = rollbar['timestamp']
-    environment = rollbar['data']['environment']
-    level = rollbar['data']['level']
-    message = rollbar['data']['body'].get('message', {})
-    extra = message.get('extra', {})
-    status_code = extra.get('status_code', '')
-    request_path = extra.get('request_path', '')
-    error_message = extra.get('error_message', '')
+    buf = io.StringIO()
+    csv.writer(buf).writerows(
+        [COPY_NULL if value is None else value for value in row] for row in rows
+    )
+    buf.seek(0)
 
-    try:
-        # I trust inputs from Rollbar so I won't escape them.
-        cursor.execute(f'''
-            INSERT INTO rollbars
-            (id, project_id, environment, request_path, status_code, "timestamp", level)
-            VALUES (%s, %s, %s, %s, %s, %s, %s);
-        ''', (id_, project_id, environment, request_path, status_code, timestamp, level))
-    except psycopg2.errors.UniqueViolation:
-        # Skip duplicates
-        pass
-
-
-def get(page: int):
+    cursor.copy_expert(f'''
+        COPY rollbars_stage
+        (id, project_id, environment, request_path, status_code, "timestamp", level)
+        FROM STDIN WITH (FORMAT CSV, NULL '{COPY_NULL}');
+    ''', buf)
+
+
+def merge(cursor):
+    '''Move the staged Rollbars into the empty rollbars table, skipping duplicates.
+
+    Arguments:
+        - cursor: psycopg2 cursor
+    '''
+    cursor.execute('''
+        INSERT INTO rollbars
+        SELECT DISTINCT ON (id) * FROM rollbars_stage;
+    ''')
+
+    cursor.execute('''
+        DROP TABLE rollbars_stage;
+    ''')
+
+
+def get(page: int, url: str, rollbar_token: str, rows: queue.Queue, failed: threading.Event):
     '''Get the occurences of the Rollbar.
     
     Arguments:
         - page: int, the rollbars are paginated (like almost any API)
+        - url: str, the instances URL of the Rollbar (see instances_url)
+        - rollbar_token: str, the Rollbar project access token
+        - rows: queue.Queue, parsed rollbars are put here for write()
+        - failed: threading.Event, set by write() when a writer gives up
     '''
-    rollbar_id = os.environ.get('ROLLBAR_ID')
-    rollbar_token = os.environ.get('ROLLBAR_TOKEN')
-    resp = requests.get(f'https://api.rollbar.com/api/1/item/{rollbar_id}/instances?access_token={rollbar_token}&page={page}')
+    if failed.is_set():
+        raise RuntimeError(f'Skipping page {page}, could not write Rollbars to the DB.')
 
-    # Create Postgres connection
-    cursor, conn = psql()
-    
+    started = time.perf_counter()
+    resp = SESSION.get(url, params={'access_token': rollbar_token, 'page': page}, timeout=HTTP_TIMEOUT)
+    fetched = time.perf_counter()
+
+    # Parse here, so writers only hand ready-made rows to COPY
     try:
-        for rollbar in resp.json()['result']['instances']:
-            insert(rollbar, cursor)
-        conn.commit()
+        parsed = [parse(rollbar) for rollbar in orjson.loads(resp.content)['result']['instances']]
     except Exception as e:
-        raise e
         print(f'Failed to fetch Rollbars: {e}')
         print(f'Page {page}')
-        conn.rollback()
-    finally:
-        conn.close()
+        raise e
 
     if DEBUG:
-        print(f'Done with page {page}')
+        print(f'Done with page {page} (fetch: {fetched - started:.3f}s, parse: {time.perf_counter() - fetched:.3f}s)')
+
+    rows.put(parsed)
+
+
+def write(rows: queue.Queue, failed: threading.Event):
+    '''Write parsed Rollbars to the DB, BATCH_SIZE rows per transaction.
+
+    Arguments:
+        - rows: queue.Queue, lists of parsed rollbars, terminated by None
+        - failed: threading.Event, set on error so get() stops fetching
+    '''
+    conn = POOL.getconn()
+    batch = []
+    page = []
+
+    try:
+        with conn.cursor() as cursor:
+            while page is not None:
+                page = rows.get()
+
+                if page is not None:
+                    batch.extend(page)
+
+                if batch and (page is None or len(batch) >= BATCH_SIZE):
+                    started = time.perf_counter()
+                    insert(batch, cursor)
+                    conn.commit()
 
+                    if DEBUG:
+                        print(f'Wrote {len(batch)} rollbars ({time.perf_counter() - started:.3f}s)')
 
-def psql():
-    '''Get cursor and connection to Postgres.'''
+                    batch = []
+    except Exception as e:
+        print(f'Failed to write Rollbars: {e}')
+        failed.set()
+
+        # The connection itself may be gone
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+
+        raise e
+    finally:
+        # Keep draining so fetchers don't block forever on the full queue
+        while page is not None:
+            page = rows.get()
+
+        POOL.putconn(conn)
+
+
+def __conn_string(dbname=None):
+    '''Get the Postgres connection string.
+
+    Arguments:
+        - dbname: str, database to connect to, defaults to __dbname()
+    '''
     # Brew sets up Postgres with the system user
-    dbname = __dbname()
+    dbname = dbname or __dbname()
     user = os.environ.get('POSTGRES_USER', __unix_user())
     host = os.environ.get('POSTGRES_HOST', DEFAULT_POSTGRES_HOST)
     password = os.environ.get('POSTGRES_PASSWORD', False)
@@ -181,35 +321,120 @@ def psql():
     if DEBUG:
         print(f'Connecting to {conn_string}')
 
-    conn = psycopg2.connect(conn_string_secure)
+    return conn_string_secure
+
+
+def http_session(workers: int):
+    '''Get a requests session with a keep-alive connection for each fetcher thread.
+
+    Arguments:
+        - workers: int, how many threads will share the session
+    '''
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(
+        pool_connections=workers,
+        pool_maxsize=workers,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504]),
+    ))
+
+    return session
+
+
+def psql(dbname=None):
+    '''Get cursor and connection to Postgres.
+
+    Arguments:
+        - dbname: str, database to connect to, defaults to __dbname()
+    '''
+    conn = psycopg2.connect(__conn_string(dbname))
     cursor = conn.cursor()
 
     return cursor, conn
 
 
-def main(counter, num_rollbars):
+def psql_pool(minconn: int, maxconn: int):
+    '''Get a thread-safe pool of connections to Postgres.
+
+    Arguments:
+        - minconn: int, connections opened up front
+        - maxconn: int, most connections the pool will ever hold
+    '''
+    return ThreadedConnectionPool(minconn, maxconn, __conn_string())
+
+
+def main(counter, num_rollbars, workers=DEFAULT_WORKERS, writers=DEFAULT_WRITERS):
     '''Entrypoint.
 
     Arguments:
         - counter: Rollbar counter (i.e. http://rollbar.com/company/project/<counter>)
         - num_rollbars: How many rollbars to fetch (from the beginning of time)
+        - workers: How many pages to fetch concurrently
+        - writers: How many threads to write to Postgres with
     '''
+    rollbar_token = os.environ.get('ROLLBAR_TOKEN')
 
-    setup_db(backup=False)
-    setup_rollbar_id(counter)
+    if not rollbar_token:
+        print('ROLLBAR_TOKEN is not set. It should be the Rollbar project access token.')
+        exit(1)
 
-    with multiprocessing.Pool(20) as pool:
-        pages = math.ceil(num_rollbars / 20) + 1 # Rollbar returns pages of 20 items.
+    global SESSION, POOL
+    SESSION = http_session(workers)
 
-        print('Fetching rollbars...')
-        for _ in tqdm.tqdm(pool.imap_unordered(get, range(1, pages)), total=pages - 1): # Page count starts at 1
-            pass
+    setup_db(backup=False)
+    rollbar_id = setup_rollbar_id(counter, rollbar_token)
+
+    POOL = psql_pool(writers, writers)
+
+    # Fetching and writing overlap: fetchers fill the queue while writers drain it.
+    rows = queue.Queue(maxsize=QUEUE_SIZE)
+    failed = threading.Event()
+    fetch = functools.partial(get, url=instances_url(rollbar_id), rollbar_token=rollbar_token, rows=rows, failed=failed)
+
+    # Writers batch many pages per transaction, so fetchers never wait on commits.
+    with ThreadPoolExecutor(max_workers=writers) as writer:
+        written = [writer.submit(write, rows, failed) for _ in range(writers)]
+
+        try:
+            # The work is all network I/O, so threads are as fast as processes and much lighter.
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pages = math.ceil(num_rollbars / PAGE_SIZE)
+                futures = [executor.submit(fetch, page) for page in range(1, pages + 1)] # Page count starts at 1
+
+                print('Fetching rollbars...')
+                try:
+                    for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+                        future.result()
+                except:
+                    executor.shutdown(cancel_futures=True)
+                    raise
+        finally:
+            for _ in written:
+                rows.put(None) # Let each writer flush and exit
+
+            # A writer error takes precedence over the fetch errors it caused
+            for future in written:
+                future.result()
+
+    POOL.closeall()
 
     # Prepare table for querying
     cursor, conn = psql()
 
+    print('Removing duplicate rollbars...')
+    merge(cursor)
+    conn.commit()
+
     print('Running "ANALYZE rollbars;" to optimize for querying...')
     cursor.execute('ANALYZE rollbars;')
+
+    print('Making rollbars crash-safe...')
+    cursor.execute('ALTER TABLE rollbars SET LOGGED;')
+
+    # One index build at the end is much cheaper than maintaining it on every insert.
+    print('Indexing rollbars by ID...')
+    cursor.execute('CREATE UNIQUE INDEX rollbars_id_idx ON rollbars (id);')
+
+    conn.commit()
     conn.close()
 
     print(f'Done. The rollbars are now available in the "{__dbname()}" database.')
@@ -221,7 +446,9 @@ if __name__ == '__main__':
 
     parser.add_argument('counter', type=int, help='The Rollbar counter in your Rollbar project.')
     parser.add_argument('num_rollbars', type=int, help='The quantity of Rollbars to import.')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help=f'How many pages to fetch concurrently (default: {DEFAULT_WORKERS}).')
+    parser.add_argument('--writers', type=int, default=DEFAULT_WRITERS, help=f'How many Postgres connections to write with (default: {DEFAULT_WRITERS}).')
 
     args = parser.parse_args()
 
-    main(args.counter, args.num_rollbars)
+    main(args.counter, args.num_rollbars, args.workers, args.writers)